@@ -1,12 +1,81 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import functools
 import inspect
+import itertools
+import operator
 
 
+from django.core.exceptions import ImproperlyConfigured
 from rest_framework import permissions
 
 
+DEPENDENCIES_ATTR = "_composed_permissions_dependencies"
+
+# Component methods that load the dependencies declared on "needs"
+DEPENDENT_METHODS = ("has_permission", "has_object_permission",
+                     "filter_permitted_objects", "get_object_permission_q")
+
+
+def _get_dependencies(request):
+    if request is None:
+        raise ImproperlyConfigured("Dependencies are stored on the request, "
+                                   "they can not be used without request")
+
+    dependencies = getattr(request, DEPENDENCIES_ATTR, None)
+    if dependencies is None:
+        dependencies = {}
+        setattr(request, DEPENDENCIES_ATTR, dependencies)
+    return dependencies
+
+
+def resolve_dependencies(names, permission, request, view):
+    """
+    Load the named dependencies with the providers of the
+    composed permission, only once per request.
+
+    Dependencies are shared by all the composed permissions that
+    evaluate the request, so one name can not be loaded by
+    different providers.
+
+    Returns the names that were loaded by this call.
+    """
+    dependencies = _get_dependencies(request)
+    loaded = []
+
+    for name in names:
+        try:
+            provider = permission.dependency_providers[name]
+        except KeyError:
+            raise ImproperlyConfigured("No provider for dependency '{0}' on {1}"
+                                       .format(name, type(permission).__name__))
+
+        if name in dependencies:
+            if dependencies[name][0] is not provider:
+                raise ImproperlyConfigured("Dependency '{0}' of {1} is already loaded by "
+                                           "other provider on this request"
+                                           .format(name, type(permission).__name__))
+            continue
+
+        dependencies[name] = (provider, provider(permission, request, view))
+        loaded.append(name)
+
+    return loaded
+
+
+def get_dependency(request, name):
+    """
+    Return the value of a dependency declared on the
+    `needs` attribute of the calling component.
+    """
+    try:
+        return _get_dependencies(request)[name][1]
+    except KeyError:
+        raise ImproperlyConfigured("Dependency '{0}' is not resolved, it should be "
+                                   "declared on component 'needs'".format(name))
+
+
 class BaseComposedPermission(permissions.BasePermission):
     """
     Base class for compose permission with permission
@@ -50,13 +119,18 @@ class BaseComposedPermission(permissions.BasePermission):
             # global_permission_set = (lambda self: Component1() | Component2())
     """
 
+    # Mapping of dependency names to functions that load them, called
+    # as provider(permission, request, view) the first time a component
+    # that needs the dependency is evaluated on a request.
+    dependency_providers = {}
+
     def global_permission_set(self):
         raise NotImplementedError()
 
     def object_permission_set(self):
         raise NotImplementedError()
 
-    def _evaluate_permission_set(self, permission_set):
+    def _evaluate_permission_set(self, permission_set, request=None):
         # Evaluate components
         permission_set = permission_set()
 
@@ -70,20 +144,55 @@ class BaseComposedPermission(permissions.BasePermission):
         return _permission_set
 
     def has_permission(self, request, view):
-        permission_set = self._evaluate_permission_set(self.global_permission_set)
+        permission_set = self._evaluate_permission_set(self.global_permission_set, request)
         return permission_set.has_permission(self, request, view)
 
     def has_object_permission(self, request, view, obj):
-        permission_set = self._evaluate_permission_set(self.object_permission_set)
+        permission_set = self._evaluate_permission_set(self.object_permission_set, request)
         return permission_set.has_object_permission(self, request, view, obj)
 
+    def iter_permitted(self, request, view, iterable, chunk_size=100):
+        """
+        Lazily filter an iterable of objects through the object
+        permission set, yielding only permitted objects.
+
+        Objects are consumed in chunks of `chunk_size` and, before
+        checking a chunk, every component receives it through
+        `prepare_object_chunk` so it can prefetch related data.
+        Each chunk is then checked with `filter_permitted_objects`.
+        Only one chunk is held in memory at a time, which makes this
+        suitable for `queryset.iterator()`.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer")
+
+        permission_set = self._evaluate_permission_set(self.object_permission_set, request)
+        return self._iter_permitted(permission_set, request, view, iterable, chunk_size)
+
+    def _iter_permitted(self, permission_set, request, view, iterable, chunk_size):
+        iterator = iter(iterable)
+
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+
+            permission_set.prepare_object_chunk(self, request, view, chunk)
+            for obj in permission_set.filter_permitted_objects(self, request, view, chunk):
+                yield obj
+
 
 class BasePermissionComponent(object):
     """
     Base class for permission component.
     Is a unit permission class.
+
+    `needs` lists the names of the dependencies used by the
+    component, that are available with `get_dependency`.
     """
 
+    needs = ()
+
     def has_permission(self, permission, request, view):
         raise NotImplementedError()
 
@@ -91,6 +200,29 @@ class BasePermissionComponent(object):
         # By default return same as that "has_permission" method
         return self.has_permission(permission, request, view)
 
+    def prepare_object_chunk(self, permission, request, view, objs):
+        # Hook called with each chunk of objects before they are
+        # checked by "iter_permitted". Does nothing by default.
+        pass
+
+    def filter_permitted_objects(self, permission, request, view, objs):
+        # Return the list of objects of a chunk that are permitted.
+        # By default checks them one by one with "has_object_permission".
+        return [obj for obj in objs
+                if self.has_object_permission(permission, request, view, obj)]
+
+    def get_object_permission_q(self, permission, request, view):
+        # Return a Q object equivalent to "has_object_permission"
+        # for filtering querysets on database, or None if this
+        # component can only be checked object by object.
+        return None
+
+    def get_method_result(self, method):
+        # Return the result of this component (for both global and
+        # object permissions) when it only depends on the http method,
+        # or None. Used for specializing permission sets per method.
+        return None
+
     def __and__(self, component):
         return And(self, component)
 
@@ -112,10 +244,28 @@ class RestPermissionComponent(BasePermissionComponent):
     def has_permission(self, request, view):
         raise NotImplementedError()
 
+    def _prepare_object_chunk(self, permission, request, view, objs):
+        return self.prepare_object_chunk(request, view, objs)
+
+    def _filter_permitted_objects(self, permission, request, view, objs):
+        return self.filter_permitted_objects(request, view, objs)
+
+    def _get_object_permission_q(self, permission, request, view):
+        return self.get_object_permission_q(request, view)
+
     def has_object_permission(self, request, view, obj):
         # By default return same as that "has_permission" method
         return self.has_permission(request, view)
 
+    def prepare_object_chunk(self, request, view, objs):
+        pass
+
+    def filter_permitted_objects(self, request, view, objs):
+        return [obj for obj in objs if self.has_object_permission(request, view, obj)]
+
+    def get_object_permission_q(self, request, view):
+        return None
+
 
 class BasePermissionSet(object):
     """
@@ -133,6 +283,11 @@ class BasePermissionSet(object):
         return name
 
     def get_component_result(self, component, method_name, *args, **kwargs):
+        # Dependencies are only loaded by the branches that are evaluated
+        needs = getattr(component, "needs", None)
+        if needs and method_name in DEPENDENT_METHODS:
+            resolve_dependencies(needs, *args[:3])
+
         final_method_name = self.update_method_name(method_name, component)
         method = getattr(component, final_method_name)
         return method(*args, **kwargs)
@@ -147,6 +302,32 @@ class BasePermissionSet(object):
     def has_object_permission(self, permission, request, view, obj):
         return self._check_permission("has_object_permission", permission,
                                       request, view, obj)
+
+    def prepare_object_chunk(self, permission, request, view, objs):
+        for component in self.components:
+            self.get_component_result(component, "prepare_object_chunk",
+                                      permission, request, view, objs)
+
+    def filter_permitted_objects(self, permission, request, view, objs):
+        return [obj for obj in objs
+                if self.has_object_permission(permission, request, view, obj)]
+
+    def get_object_permission_q(self, permission, request, view):
+        return None
+
+    def _get_components_q(self, permission, request, view):
+        # Returns Q objects of all components or None if
+        # any of them does not support database filtering.
+        result = []
+        for component in self.components:
+            q = self.get_component_result(component, "get_object_permission_q",
+                                          permission, request, view)
+            if q is None:
+                return None
+            result.append(q)
+
+        return result
+
     def __invert__(self):
         return Not(self)
 
@@ -160,6 +341,18 @@ class Not(BasePermissionSet):
         result = self.get_component_result(self.components[0], 'has_object_permission', *args, **kwargs)
         return not result
 
+    def filter_permitted_objects(self, permission, request, view, objs):
+        permitted = self.get_component_result(self.components[0], 'filter_permitted_objects',
+                                              permission, request, view, objs)
+        permitted = set(id(obj) for obj in permitted)
+        return [obj for obj in objs if id(obj) not in permitted]
+
+    def get_object_permission_q(self, *args, **kwargs):
+        q = self.get_component_result(self.components[0], 'get_object_permission_q', *args, **kwargs)
+        if q is None:
+            return None
+        return ~q
+
 
 class Or(BasePermissionSet):
     def _check_permission(self, method_name, *args, **kwargs):
@@ -173,6 +366,28 @@ class Or(BasePermissionSet):
 
         return valid
 
+    def filter_permitted_objects(self, permission, request, view, objs):
+        # Each component only checks the objects denied by the previous ones
+        permitted = set()
+        remaining = list(objs)
+
+        for component in self.components:
+            if not remaining:
+                break
+
+            result = self.get_component_result(component, "filter_permitted_objects",
+                                               permission, request, view, remaining)
+            permitted.update(id(obj) for obj in result)
+            remaining = [obj for obj in remaining if id(obj) not in permitted]
+
+        return [obj for obj in objs if id(obj) in permitted]
+
+    def get_object_permission_q(self, permission, request, view):
+        queries = self._get_components_q(permission, request, view)
+        if not queries:
+            return None
+        return functools.reduce(operator.or_, queries)
+
     def __and__(self, component):
         return And(self, component)
 
@@ -194,6 +409,25 @@ class And(BasePermissionSet):
 
         return valid
 
+    def filter_permitted_objects(self, permission, request, view, objs):
+        # Each component only checks the objects permitted by the previous ones
+        objs = list(objs)
+
+        for component in self.components:
+            if not objs:
+                break
+
+            objs = self.get_component_result(component, "filter_permitted_objects",
+                                             permission, request, view, objs)
+
+        return list(objs)
+
+    def get_object_permission_q(self, permission, request, view):
+        queries = self._get_components_q(permission, request, view)
+        if not queries:
+            return None
+        return functools.reduce(operator.and_, queries)
+
     def __and__(self, component):
         components = copy.copy(self.components)
         components.append(component)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from .profiling import instrument
+
+
+logger = logging.getLogger("restfw_composed_permissions")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget(object):
+    """
+    Recorder that collects the database queries issued by each
+    node of one permission set evaluation and checks them against
+    the `query_budget` of the components and of the whole tree.
+    """
+
+    def __init__(self, permission):
+        self.permission = permission
+        self.queries = {}
+
+    def record(self, node, elapsed, short_circuited, queries):
+        self.queries[node.path] = self.queries.get(node.path, 0) + queries
+
+        if len(node.path) == 1:
+            budget = self.permission.query_budget
+        else:
+            budget = getattr(node.components[0], "query_budget", None)
+
+        if budget is not None and queries > budget:
+            self.exceeded(node, queries, budget)
+
+    def record_dependency(self, path, elapsed, queries):
+        # Dependency queries only count for the budget of the tree
+        self.queries[path] = self.queries.get(path, 0) + queries
+
+    def exceeded(self, node, queries, budget):
+        message = "Permission {0} ({1}) issued {2} queries, budget is {3}".format(
+            type(self.permission).__name__, ";".join(node.path), queries, budget)
+
+        if self.permission.query_budget_action == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+class QueryBudgetMixin(object):
+    """
+    Mixin for `BaseComposedPermission` subclasses that counts the
+    database queries issued by each node of the permission sets.
+
+    When a component issues more queries than its `query_budget`
+    attribute, or the whole permission set more than the
+    `query_budget` of the composed permission, the excess is logged
+    or, with `query_budget_action = "raise"`, `QueryBudgetExceeded`
+    is raised.
+
+    The queries of the last evaluation are available on
+    `query_counts`, keyed by node path, and they are also reported
+    to the `SamplingProfiler` when combined with
+    `ProfiledPermissionMixin`.
+
+    Example:
+
+    .. code-block:: python
+
+        class SomePermission(QueryBudgetMixin, BaseComposedPermission):
+            query_budget = 2
+            query_budget_action = "raise"
+            global_permission_set = (lambda self: Component1() | Component2())
+    """
+
+    query_budget = None
+    query_budget_action = "log"
+
+    def _evaluate_permission_set(self, permission_set, request=None):
+        permission_set = super(QueryBudgetMixin, self)._evaluate_permission_set(permission_set,
+                                                                                request)
+
+        budget = QueryBudget(self)
+        self.query_counts = budget.queries
+        return instrument(permission_set, budget)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+
+from .base import BasePermissionSet, And, Or
+
+
+# Types whose repr is the same on all processes
+SIMPLE_TYPES = (type(None), bool, int, float, type(""), type(u""))
+
+
+def _class_identity(cls):
+    name = getattr(cls, "__qualname__", cls.__name__)
+    # Classes defined inside functions can share the qualified name
+    if "<locals>" in name or cls.__name__ != name.rsplit(".", 1)[-1]:
+        raise ValueError("class {0} is not defined at module level".format(name))
+    return "{0}.{1}".format(cls.__module__, name)
+
+
+def _value_identity(value):
+    if isinstance(value, SIMPLE_TYPES):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return "({0})".format(",".join(_value_identity(v) for v in value))
+    if isinstance(value, dict):
+        items = sorted("{0}:{1}".format(_value_identity(k), _value_identity(v))
+                       for k, v in value.items())
+        return "{{{0}}}".format(",".join(items))
+    raise ValueError("attribute of type {0} can not be identified"
+                     .format(type(value).__name__))
+
+
+def component_identity(component):
+    """
+    Return a string that identifies a component or permission set
+    by its class and attributes, used for namespacing cache keys.
+
+    Only attributes of simple types (strings, numbers, booleans,
+    None, and tuples, lists or dicts of them) are supported, others
+    raise `ValueError`, as their repr may run code (like querysets)
+    or differ between processes.
+    """
+    if isinstance(component, Cached):
+        return "{0}[{1}]({2})".format(_class_identity(type(component)),
+                                      component.key_prefix, component.component_identity)
+
+    attrs = sorted((k, v) for k, v in vars(component).items() if k != "components")
+    identity = "{0}[{1}]".format(_class_identity(type(component)),
+                                 ",".join("{0}={1}".format(k, _value_identity(v))
+                                          for k, v in attrs))
+
+    if isinstance(component, BasePermissionSet):
+        children = ",".join(component_identity(c) for c in component.components)
+        identity = "{0}({1})".format(identity, children)
+
+    return identity
+
+
+class Cached(BasePermissionSet):
+    """
+    Permission set that stores the decision of one component
+    (or permission set) on a django cache backend.
+
+    `key_func` receives the same arguments as the wrapped component
+    (permission, request, view and, for object permissions, obj) and
+    must return a string identifying the decision, or None for not
+    caching it.
+
+    Cache keys include the identity of the wrapped component (its
+    class and attributes, recursively for permission sets) and the
+    optional `key_prefix`, so different `Cached` nodes sharing a
+    `key_func` never read each other decisions. Components that can
+    not be identified (classes defined inside functions, or
+    attributes that are not simple values) require a `key_prefix`
+    identifying them.
+
+    Decisions are stored through django cache framework, so when it is
+    configured with a backend shared by all workers, the decisions are
+    shared by all processes instead of warming up one cache per worker.
+
+    Example:
+
+    .. code-block:: python
+
+        def user_key(permission, request, view, obj=None):
+            if obj is None:
+                return "user:{0}".format(request.user.pk)
+            return "user:{0}:obj:{1}".format(request.user.pk, obj.pk)
+
+        class SomePermission(BaseComposedPermission):
+            global_permission_set = (lambda self:
+                                        Cached(ExpensiveComponent, user_key, timeout=60))
+    """
+
+    key_prefix = "restfw_composed_permissions"
+
+    def __init__(self, component, key_func, timeout=DEFAULT_TIMEOUT,
+                 cache_alias="default", key_prefix=None):
+        super(Cached, self).__init__(component)
+        self.key_func = key_func
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+        if key_prefix is not None:
+            self.key_prefix = "{0}:{1}".format(self.key_prefix, key_prefix)
+
+        try:
+            self.component_identity = component_identity(self.components[0])
+        except ValueError as e:
+            if key_prefix is None:
+                raise ImproperlyConfigured("Cached component can not be identified ({0}), "
+                                           "a key_prefix is required".format(e))
+            self.component_identity = ""
+
+    def make_key(self, method_name, key):
+        # Hash user keys for keep them valid on all cache backends
+        key = "{0}:{1}:{2}".format(self.component_identity, method_name, key)
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return "{0}:{1}".format(self.key_prefix, digest)
+
+    def _check_permission(self, method_name, *args, **kwargs):
+        key = self.key_func(*args, **kwargs)
+        if key is None:
+            return self.get_component_result(self.components[0], method_name,
+                                             *args, **kwargs)
+
+        cache = caches[self.cache_alias]
+        key = self.make_key(method_name, key)
+
+        result = cache.get(key)
+        if result is None:
+            result = bool(self.get_component_result(self.components[0], method_name,
+                                                    *args, **kwargs))
+            cache.set(key, result, self.timeout)
+
+        return result
+
+    def get_object_permission_q(self, *args, **kwargs):
+        return self.get_component_result(self.components[0], "get_object_permission_q",
+                                         *args, **kwargs)
+
+    def __and__(self, component):
+        return And(self, component)
+
+    def __or__(self, component):
+        return Or(self, component)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.db import NotSupportedError
+from django.db.models.query import ModelIterable
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from rest_framework.filters import BaseFilterBackend
+
+from .base import BaseComposedPermission, BasePermissionSet, And, Or
+from .profiling import InstrumentedNode
+
+
+def permitted_iterable_class(base, permission, permission_set, request, view, chunk_size):
+    """
+    Build a queryset iterable class that yields only the model
+    instances of `base` allowed by `permission_set`, checked in
+    chunks with `iter_permitted` while the queryset is iterated.
+    """
+    class PermittedModelIterable(base):
+        def __iter__(self):
+            objs = super(PermittedModelIterable, self).__iter__()
+            return permission._iter_permitted(permission_set, request, view,
+                                              objs, chunk_size)
+
+    return PermittedModelIterable
+
+
+class PermittedQuerySetMixin(object):
+    """
+    Mixin for querysets with python permission checks attached.
+
+    Counting, checking existence and slicing iterate over the
+    permitted objects, so they agree with the iteration of the
+    queryset. Methods that would bypass the checks, like `values()`
+    or `aggregate()`, raise `NotSupportedError`.
+    """
+
+    def _iter_checked(self):
+        return self.iterator(chunk_size=GET_ITERATOR_CHUNK_SIZE)
+
+    def _not_supported(self, name):
+        raise NotSupportedError("{0}() is not supported on querysets with python "
+                                "permission checks".format(name))
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return sum(1 for _ in self._iter_checked())
+
+    def exists(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return any(True for _ in self._iter_checked())
+
+    def __getitem__(self, k):
+        if self._result_cache is not None or not isinstance(k, (int, slice)):
+            return super(PermittedQuerySetMixin, self).__getitem__(k)
+
+        # Database limits would be applied before the python checks
+        if isinstance(k, slice):
+            if (k.start or 0) < 0 or (k.stop or 0) < 0:
+                raise ValueError("Negative indexing is not supported.")
+            return list(itertools.islice(self._iter_checked(), k.start, k.stop, k.step))
+
+        if k < 0:
+            raise ValueError("Negative indexing is not supported.")
+        for obj in itertools.islice(self._iter_checked(), k, None):
+            return obj
+        raise IndexError("list index out of range")
+
+    def values(self, *args, **kwargs):
+        self._not_supported("values")
+
+    def values_list(self, *args, **kwargs):
+        self._not_supported("values_list")
+
+    def aggregate(self, *args, **kwargs):
+        self._not_supported("aggregate")
+
+    def earliest(self, *args, **kwargs):
+        self._not_supported("earliest")
+
+    def latest(self, *args, **kwargs):
+        self._not_supported("latest")
+
+    def update(self, *args, **kwargs):
+        self._not_supported("update")
+
+    def delete(self, *args, **kwargs):
+        self._not_supported("delete")
+
+
+_permitted_queryset_classes = {}
+
+
+def permitted_queryset_class(queryset_class):
+    """
+    Return a subclass of `queryset_class` with `PermittedQuerySetMixin`.
+    """
+    if issubclass(queryset_class, PermittedQuerySetMixin):
+        return queryset_class
+
+    cls = _permitted_queryset_classes.get(queryset_class)
+    if cls is None:
+        cls = type("Permitted" + queryset_class.__name__,
+                   (PermittedQuerySetMixin, queryset_class), {})
+        _permitted_queryset_classes[queryset_class] = cls
+    return cls
+
+
+class ComposedPermissionFilterBackend(BaseFilterBackend):
+    """
+    Filter backend that applies the `object_permission_set` of the
+    view composed permissions to list querysets, so list endpoints
+    have the same semantics as detail endpoints.
+
+    Each node of the permission set is filtered with the fastest
+    strategy that it supports:
+
+    - Nodes returning a Q object from `get_object_permission_q`
+      that is valid for the queryset model are applied as a
+      database filter.
+    - The remaining nodes are checked in python while the queryset
+      is iterated (after pagination slices it), in chunks with
+      `iter_permitted`, so components can prefetch data in bulk
+      with `prepare_object_chunk` and memory use is constant.
+
+    When python checks are needed, the queryset counts and slices
+    the permitted objects by iterating over them (see
+    `PermittedQuerySetMixin`), and methods that can not apply the
+    checks, like `values()` or `aggregate()`, raise
+    `NotSupportedError`.
+
+    Example:
+
+    .. code-block:: python
+
+        class SomeViewSet(viewsets.ModelViewSet):
+            permission_classes = (SomePermission,)
+            filter_backends = (ComposedPermissionFilterBackend,)
+    """
+
+    chunk_size = 100
+
+    def filter_queryset(self, request, queryset, view):
+        for permission in view.get_permissions():
+            if isinstance(permission, BaseComposedPermission):
+                queryset = self.filter_by_permission(permission, request, queryset, view)
+
+        return queryset
+
+    def filter_by_permission(self, permission, request, queryset, view):
+        try:
+            permission_set = permission._evaluate_permission_set(permission.object_permission_set,
+                                                                 request)
+        except NotImplementedError:
+            return queryset
+
+        queries, remaining = self.split_permission_set(permission, request, view,
+                                                       permission_set, queryset)
+        for q in queries:
+            queryset = queryset.filter(q)
+
+        if not remaining:
+            return queryset
+
+        if not issubclass(queryset._iterable_class, ModelIterable):
+            raise ImproperlyConfigured("{0} can only check querysets of model instances"
+                                       .format(type(self).__name__))
+
+        queryset = queryset.all()
+        queryset.__class__ = permitted_queryset_class(type(queryset))
+        queryset._iterable_class = permitted_iterable_class(queryset._iterable_class,
+                                                            permission, And(*remaining),
+                                                            request, view, self.chunk_size)
+        return queryset
+
+    def get_valid_q(self, queryset, q):
+        # Q objects that can not be applied to the queryset model (like
+        # lookups on properties or values of other types) are discarded
+        # and their nodes are checked object by object.
+        if q is None:
+            return None
+
+        try:
+            queryset.filter(q)
+        except (FieldError, TypeError, ValueError):
+            return None
+        return q
+
+    def split_permission_set(self, permission, request, view, permission_set, queryset):
+        """
+        Split a permission set in a list of Q objects and a list of
+        nodes that must be checked object by object. Both lists are
+        joined with `And`.
+        """
+        # Instrumented permission sets are split by their wrapped set,
+        # instrumented leaves are kept wrapped, so their Q objects go
+        # through "get_component_result" like any other leaf.
+        if (isinstance(permission_set, InstrumentedNode) and
+                isinstance(permission_set.components[0], BasePermissionSet)):
+            return self.split_permission_set(permission, request, view,
+                                             permission_set.components[0], queryset)
+
+        q = self.get_valid_q(queryset, permission_set.get_object_permission_q(permission,
+                                                                              request, view))
+        if q is not None:
+            return [q], []
+
+        # Children of "And" (or of an "Or" with only one child, as
+        # created by BaseComposedPermission) can be split separately.
+        is_and = isinstance(permission_set, And)
+        is_single_or = isinstance(permission_set, Or) and len(permission_set.components) == 1
+        if not (is_and or is_single_or):
+            return [], [permission_set]
+
+        queries, remaining = [], []
+        for component in permission_set.components:
+            if isinstance(component, BasePermissionSet):
+                _queries, _remaining = self.split_permission_set(permission, request, view,
+                                                                 component, queryset)
+            else:
+                q = permission_set.get_component_result(component, "get_object_permission_q",
+                                                        permission, request, view)
+                q = self.get_valid_q(queryset, q)
+                _queries, _remaining = ([q], []) if q is not None else ([], [component])
+
+            queries.extend(_queries)
+            remaining.extend(_remaining)
+
+        return queries, remaining
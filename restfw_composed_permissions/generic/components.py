@@ -1,12 +1,92 @@
 # -*- coding: utf-8 -*-
 
+import inspect
+import re
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
 from rest_framework import permissions
 from ..base import (BasePermissionComponent,
+                    BasePermissionSet,
                     BaseComposedPermision,
-                    And, Or)
+                    And, Or, Not)
+
+
+def _constant_q(value):
+    # Q objects that match all rows or none of them
+    if value:
+        return ~Q(pk__in=[])
+    return Q(pk__in=[])
+
+
+def _get_function(cls, name):
+    method = getattr(cls, name)
+    return getattr(method, "__func__", method)
+
+
+def _get_view_model(view):
+    get_queryset = getattr(view, "get_queryset", None)
+    if get_queryset is None:
+        return None
+    return getattr(get_queryset(), "model", None)
+
+
+def _get_lookup_field(model, names):
+    # Return the concrete field referenced by an attribute path,
+    # following forward relations, or None if the path does not
+    # end in a field that is not a relation.
+    field = None
+    for index, name in enumerate(names):
+        if field is not None:
+            if not field.is_relation:
+                return None
+            model = field.related_model
+
+        try:
+            field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if not field.concrete or field.many_to_many:
+            return None
+
+        # "owner_id" is the value of the related primary key
+        if field.is_relation and name == field.attname != field.name:
+            if index != len(names) - 1:
+                return None
+            field = field.target_field
+
+    if field.is_relation:
+        return None
+    return field
+
+
+def _overrides(component, cls, *names):
+    # Check if the component class redefines any of the
+    # named methods after (or instead of) the given class.
+    return any(_get_function(type(component), name) is not _get_function(cls, name)
+               for name in names)
+
+
+class RequestPermissionComponent(BasePermissionComponent):
+    """
+    Base class for components that only depend on the request,
+    so their object permission can be translated to a constant
+    database filter.
+
+    Subclasses that redefine `has_object_permission` (or
+    `filter_permitted_objects`) depend on the object, so they
+    are checked object by object.
+    """
 
+    def get_object_permission_q(self, permission, request, view):
+        if _overrides(self, BasePermissionComponent, "has_object_permission",
+                      "filter_permitted_objects"):
+            return None
+        return _constant_q(self.has_permission(permission, request, view))
 
-class AllowAll(BasePermissionComponent):
+
+class AllowAll(RequestPermissionComponent):
     """
     Always allow all requests without
     any constraints.
@@ -15,8 +95,23 @@ class AllowAll(BasePermissionComponent):
     def has_permission(self, permission, request, view):
         return True
 
+    def get_method_result(self, method):
+        return True
+
 
-class AllowOnlyAnonymous(BasePermissionComponent):
+class DenyAll(RequestPermissionComponent):
+    """
+    Always deny all requests.
+    """
+
+    def has_permission(self, permission, request, view):
+        return False
+
+    def get_method_result(self, method):
+        return False
+
+
+class AllowOnlyAnonymous(RequestPermissionComponent):
     """
     Allow only anonymous requests.
     """
@@ -25,19 +120,22 @@ class AllowOnlyAnonymous(BasePermissionComponent):
         return request.user.is_anonymous
 
 
-class AllowOnlyAuthenticated(BasePermissionComponent):
+class AllowOnlyAuthenticated(RequestPermissionComponent):
     def has_permission(self, permission, request, view):
         if request.user.is_anonymous:
             return False
         return True
 
 
-class AllowOnlySafeHttpMethod(BasePermissionComponent):
+class AllowOnlySafeHttpMethod(RequestPermissionComponent):
     def has_permission(self, permission, request, view):
         if request.method in permissions.SAFE_METHODS:
             return True
         return False
 
+    def get_method_result(self, method):
+        return method in permissions.SAFE_METHODS
+
 
 class ObjectAttrEqualToObjectAttr(BasePermissionComponent):
     """
@@ -74,3 +172,187 @@ class ObjectAttrEqualToObjectAttr(BasePermissionComponent):
             return False
         else:
             return attr1_value == attr2_value
+
+    def get_object_permission_q(self, permission, request, view):
+        # Only expressions comparing an object attribute path with
+        # a value that does not depend on the object are translated,
+        # when the value has the same type as the model field, so the
+        # database compares it like python.
+        obj_attrs = [attr for attr in (self.obj_attr1, self.obj_attr2)
+                     if attr.startswith("obj.")]
+        if len(obj_attrs) != 1:
+            return None
+
+        obj_attr = obj_attrs[0]
+        value_attr = self.obj_attr2 if obj_attr is self.obj_attr1 else self.obj_attr1
+
+        lookup = obj_attr[len("obj."):]
+        if not re.match(r"^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$", lookup):
+            return None
+
+        try:
+            value = eval(value_attr, {}, {"request": request})
+        except (AttributeError, NameError):
+            return None
+
+        model = _get_view_model(view)
+        if model is None:
+            return None
+
+        names = lookup.split(".")
+        field = _get_lookup_field(model, names)
+        if field is None:
+            return None
+
+        if value is None:
+            # Python fails on the missing related objects that
+            # the database matches as NULL
+            if len(names) > 1:
+                return None
+        else:
+            try:
+                db_value = field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                return None
+            if type(db_value) is not type(value) or db_value != value:
+                return None
+
+        return Q(**{lookup.replace(".", "__"): value})
+
+
+class ByMethod(BasePermissionSet):
+    """
+    Permission set that evaluates only the component
+    defined for the http method of the request.
+
+    Methods without component are evaluated with `default`,
+    that denies all requests if it is not defined.
+
+    Example:
+
+    .. code-block:: python
+
+        class SomePermission(BaseComposedPermision):
+            global_permission_set = (lambda self: ByMethod({
+                "GET": AllowAll,
+                "POST": AllowOnlyAuthenticated() & Component1(),
+            }))
+    """
+
+    HTTP_METHODS = ("GET", "HEAD", "OPTIONS", "POST", "PUT", "PATCH", "DELETE")
+
+    def __init__(self, methods, default=None):
+        methods = sorted(methods.items())
+        components = [c for _, c in methods]
+        components.append(DenyAll if default is None else default)
+
+        super(ByMethod, self).__init__(*components)
+        self.indexes = dict((m.upper(), i) for i, (m, _) in enumerate(methods))
+
+    @classmethod
+    def compile(cls, permission_set, methods=HTTP_METHODS):
+        """
+        Build a `ByMethod` with a copy of `permission_set`
+        specialized for each one of `methods`.
+        """
+        if inspect.isclass(permission_set):
+            permission_set = permission_set()
+
+        specialized = dict((m, specialize_for_method(permission_set, m)) for m in methods)
+        return cls(specialized, default=permission_set)
+
+    def get_method_component(self, method):
+        index = self.indexes.get(method.upper(), -1)
+        return self.components[index]
+
+    def _check_permission(self, method_name, permission, request, *args, **kwargs):
+        component = self.get_method_component(request.method)
+        return self.get_component_result(component, method_name, permission,
+                                         request, *args, **kwargs)
+
+    def prepare_object_chunk(self, permission, request, view, objs):
+        component = self.get_method_component(request.method)
+        self.get_component_result(component, "prepare_object_chunk",
+                                  permission, request, view, objs)
+
+    def filter_permitted_objects(self, permission, request, view, objs):
+        return self._check_permission("filter_permitted_objects", permission,
+                                      request, view, objs)
+
+    def get_object_permission_q(self, permission, request, view):
+        component = self.get_method_component(request.method)
+        return self.get_component_result(component, "get_object_permission_q",
+                                         permission, request, view)
+
+    def __and__(self, component):
+        return And(self, component)
+
+    def __or__(self, component):
+        return Or(self, component)
+
+
+def _get_method_result(component, method):
+    # The result is only trusted when the permission methods are the
+    # ones of the class that defines "get_method_result".
+    for cls in type(component).__mro__:
+        if "get_method_result" in vars(cls):
+            break
+
+    if _overrides(component, cls, "has_permission", "has_object_permission",
+                  "filter_permitted_objects"):
+        return None
+    return component.get_method_result(method)
+
+
+def specialize_for_method(component, method):
+    """
+    Return a copy of a permission set simplified for requests
+    with the given http method: components whose result only
+    depends on the method are folded into `AllowAll` or `DenyAll`
+    and the `And`, `Or` and `Not` sets are simplified with them.
+
+    Subclasses of the permission sets, and components that redefine
+    `has_permission`, `has_object_permission` or
+    `filter_permitted_objects` without redefining `get_method_result`,
+    are kept as they are.
+    """
+    method = method.upper()
+    component_class = type(component)
+
+    if component_class is ByMethod:
+        return specialize_for_method(component.get_method_component(method), method)
+
+    if component_class is Not:
+        child = specialize_for_method(component.components[0], method)
+        if type(child) is AllowAll:
+            return DenyAll()
+        if type(child) is DenyAll:
+            return AllowAll()
+        return Not(child)
+
+    if component_class in (And, Or):
+        if component_class is And:
+            absorbing, neutral = DenyAll, AllowAll
+        else:
+            absorbing, neutral = AllowAll, DenyAll
+
+        children = []
+        for child in component.components:
+            child = specialize_for_method(child, method)
+            if type(child) is absorbing:
+                return absorbing()
+            if type(child) is not neutral:
+                children.append(child)
+
+        if not children:
+            return neutral()
+        if len(children) == 1:
+            return children[0]
+        return component_class(*children)
+
+    if isinstance(component, BasePermissionComponent):
+        result = _get_method_result(component, method)
+        if result is not None:
+            return AllowAll() if result else DenyAll()
+
+    return component
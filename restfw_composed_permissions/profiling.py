@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import random
+import threading
+from timeit import default_timer
+
+from django.db import connections
+
+from .base import BasePermissionSet, And, Or, DEPENDENT_METHODS, resolve_dependencies
+
+
+SAMPLED_ATTR = "_composed_permissions_sampled"
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts the queries executed on
+    all database connections while it is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._wrappers = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrappers = [c.execute_wrapper(self) for c in connections.all()]
+        for wrapper in self._wrappers:
+            wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for wrapper in reversed(self._wrappers):
+            wrapper.__exit__(*exc_info)
+        self._wrappers = []
+
+
+class InstrumentedNode(BasePermissionSet):
+    """
+    Permission set that wraps one node of a permission tree and
+    reports its evaluations to one or more recorders.
+    """
+
+    def __init__(self, component, path, recorder):
+        super(InstrumentedNode, self).__init__(component)
+        self.path = path
+        self.recorders = [recorder]
+        self.calls = 0
+
+    def _children(self):
+        return [c for c in getattr(self.components[0], "components", ())
+                if isinstance(c, InstrumentedNode)]
+
+    def _resolve_dependencies(self, method_name, args):
+        # Dependencies are loaded before measuring the node and their
+        # queries are reported on their own "dependency:<name>" path,
+        # instead of being charged to the first node that needs them.
+        needs = getattr(self.components[0], "needs", None)
+        if not needs or method_name not in DEPENDENT_METHODS:
+            return
+
+        for name in needs:
+            start = default_timer()
+            with QueryCounter() as queries:
+                loaded = resolve_dependencies([name], *args[:3])
+            elapsed = default_timer() - start
+
+            if loaded:
+                path = self.path[:-1] + ("dependency:{0}".format(name),)
+                for recorder in self.recorders:
+                    recorder.record_dependency(path, elapsed, queries.count)
+
+    def _check_permission(self, method_name, *args, **kwargs):
+        self._resolve_dependencies(method_name, args)
+
+        children = self._children()
+        children_calls = sum(c.calls for c in children)
+
+        start = default_timer()
+        with QueryCounter() as queries:
+            result = self.get_component_result(self.components[0], method_name, *args, **kwargs)
+        elapsed = default_timer() - start
+
+        self.calls += 1
+
+        # "And" and "Or" nodes short-circuit when some of their children are not
+        # evaluated, other sets (like "ByMethod") evaluate only one by design.
+        short_circuited = False
+        if isinstance(self.components[0], (And, Or)):
+            evaluated = sum(c.calls for c in children) - children_calls
+            short_circuited = evaluated < len(children)
+
+        for recorder in self.recorders:
+            recorder.record(self, elapsed, short_circuited, queries.count)
+        return result
+
+    def filter_permitted_objects(self, permission, request, view, objs):
+        return self._check_permission("filter_permitted_objects", permission,
+                                      request, view, objs)
+
+    def get_object_permission_q(self, *args, **kwargs):
+        return self.get_component_result(self.components[0], "get_object_permission_q",
+                                         *args, **kwargs)
+
+
+def instrument(component, recorder, path=()):
+    """
+    Return a copy of a permission tree with all its nodes
+    wrapped with `InstrumentedNode`.
+
+    Trees that are already instrumented are not copied again,
+    the recorder is added to their nodes instead.
+    """
+    if isinstance(component, InstrumentedNode):
+        component.recorders.append(recorder)
+        for child in component._children():
+            instrument(child, recorder)
+        return component
+
+    path = path + (type(component).__name__,)
+
+    if isinstance(component, BasePermissionSet):
+        component = copy.copy(component)
+        component.components = [instrument(c, recorder, path)
+                                for c in component.components]
+
+    return InstrumentedNode(component, path, recorder)
+
+
+class SamplingProfiler(object):
+    """
+    Collects per node wall time, call counts, short-circuit rates
+    and database queries of a sampled fraction of permission
+    evaluations.
+
+    The aggregated data can be exported as JSON or as collapsed
+    stacks, the input format of flamegraph tools.
+    """
+
+    def __init__(self, sample_rate=0.01):
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def should_sample(self, request=None):
+        """
+        Decide if an evaluation is instrumented. The decision is
+        stored on the request, so all the evaluations of a request
+        are sampled, or none of them.
+        """
+        if request is None:
+            return random.random() < self.sample_rate
+
+        decisions = getattr(request, SAMPLED_ATTR, None)
+        if decisions is None:
+            decisions = {}
+            setattr(request, SAMPLED_ATTR, decisions)
+
+        if id(self) not in decisions:
+            decisions[id(self)] = random.random() < self.sample_rate
+        return decisions[id(self)]
+
+    def instrument(self, permission_set):
+        return instrument(permission_set, self)
+
+    def record(self, node, elapsed, short_circuited, queries):
+        self._add(node.path, elapsed, short_circuited, queries)
+
+    def record_dependency(self, path, elapsed, queries):
+        self._add(path, elapsed, False, queries)
+
+    def _add(self, path, elapsed, short_circuited, queries):
+        with self._lock:
+            stats = self._stats.get(path)
+            if stats is None:
+                stats = self._stats[path] = {"calls": 0, "time": 0.0,
+                                             "short_circuits": 0, "queries": 0}
+
+            stats["calls"] += 1
+            stats["time"] += elapsed
+            stats["queries"] += queries
+            if short_circuited:
+                stats["short_circuits"] += 1
+
+    def report(self):
+        with self._lock:
+            stats = dict((path, dict(values)) for path, values in self._stats.items())
+
+        result = []
+        for path in sorted(stats):
+            values = stats[path]
+            children = [v for p, v in stats.items()
+                        if len(p) == len(path) + 1 and p[:-1] == path]
+            children_time = sum(v["time"] for v in children)
+            children_queries = sum(v["queries"] for v in children)
+            result.append({
+                "path": list(path),
+                "calls": values["calls"],
+                "total_time": values["time"],
+                "self_time": max(values["time"] - children_time, 0.0),
+                "short_circuit_rate": float(values["short_circuits"]) / values["calls"],
+                "queries": values["queries"],
+                "self_queries": max(values["queries"] - children_queries, 0),
+            })
+
+        return result
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+    def to_collapsed(self):
+        # One "frame;frame;frame value" line per node, with the
+        # self time in microseconds as value.
+        lines = []
+        for entry in self.report():
+            lines.append("{0} {1}".format(";".join(entry["path"]),
+                                          int(round(entry["self_time"] * 1e6))))
+        return "\n".join(lines)
+
+
+class ProfiledPermissionMixin(object):
+    """
+    Mixin for `BaseComposedPermission` subclasses that instruments
+    a sampled fraction of the evaluations with `profiler`.
+
+    Example:
+
+    .. code-block:: python
+
+        profiler = SamplingProfiler(sample_rate=0.01)
+
+        class SomePermission(ProfiledPermissionMixin, BaseComposedPermission):
+            profiler = profiler
+            global_permission_set = (lambda self: Component1() | Component2())
+    """
+
+    profiler = None
+
+    def _evaluate_permission_set(self, permission_set, request=None):
+        permission_set = super(ProfiledPermissionMixin, self)._evaluate_permission_set(permission_set,
+                                                                                       request)
+
+        profiler = self.profiler
+        if profiler is not None and profiler.should_sample(request):
+            permission_set = profiler.instrument(permission_set)
+
+        return permission_set
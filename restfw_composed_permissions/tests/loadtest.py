@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load-test harness that drives django-rest-framework views protected
+with composed permissions through `APIRequestFactory`, from several
+threads, and reports throughput, latency percentiles and queries per
+request for each permission evaluation mode.
+
+The views work on real models: list views are filtered with
+`ComposedPermissionFilterBackend` and paginated, detail views check
+object permissions, and memberships are loaded from the database.
+
+Run it with the test settings:
+
+    python -m restfw_composed_permissions.tests.loadtest --requests 5000 --concurrency 8
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+from timeit import default_timer
+
+
+MODES = ("plain", "compiled", "profiled", "cached", "budget")
+
+_models = {}
+
+
+class User(object):
+    def __init__(self, pk=None):
+        self.pk = pk
+        self.is_anonymous = pk is None
+        self.is_authenticated = pk is not None
+
+
+def get_models():
+    """
+    Define the models used by the harness. They are defined lazily
+    because the harness module is imported before django setup.
+    """
+    if not _models:
+        from django.db import models
+
+        class LoadTestItem(models.Model):
+            id = models.AutoField(primary_key=True)
+            owner = models.IntegerField()
+            group = models.IntegerField()
+            public = models.BooleanField(default=False)
+
+            class Meta:
+                app_label = "restfw_composed_permissions"
+
+        class LoadTestMembership(models.Model):
+            id = models.AutoField(primary_key=True)
+            user = models.IntegerField(db_index=True)
+            group = models.IntegerField()
+
+            class Meta:
+                app_label = "restfw_composed_permissions"
+
+        _models.update(item=LoadTestItem, membership=LoadTestMembership)
+
+    return _models["item"], _models["membership"]
+
+
+def setup_database(items=100, users=20, groups=10):
+    """
+    Create the harness tables if needed and fill them with
+    `items` items and one membership per user.
+    """
+    from django.db import connection
+
+    Item, Membership = get_models()
+    tables = connection.introspection.table_names()
+
+    with connection.schema_editor() as editor:
+        for model in (Item, Membership):
+            if model._meta.db_table not in tables:
+                editor.create_model(model)
+
+    Item.objects.all().delete()
+    Membership.objects.all().delete()
+
+    Item.objects.bulk_create([Item(owner=pk % users, group=pk % groups, public=pk % 3 == 0)
+                              for pk in range(items)])
+    Membership.objects.bulk_create([Membership(user=pk, group=pk % groups)
+                                    for pk in range(users)])
+
+
+def build_permissions():
+    from django.db.models import Q
+
+    from restfw_composed_permissions.base import (BaseComposedPermission,
+                                                  BasePermissionComponent,
+                                                  get_dependency)
+    from restfw_composed_permissions.budget import QueryBudgetMixin
+    from restfw_composed_permissions.cache import Cached
+    from restfw_composed_permissions.generic.components import (
+        AllowOnlyAuthenticated, AllowOnlySafeHttpMethod, ByMethod,
+        ObjectAttrEqualToObjectAttr)
+    from restfw_composed_permissions.profiling import (ProfiledPermissionMixin,
+                                                       SamplingProfiler)
+
+    Item, Membership = get_models()
+
+    def load_memberships(permission, request, view):
+        if request.user.is_anonymous:
+            return set()
+        return set(Membership.objects.filter(user=request.user.pk)
+                                     .values_list("group", flat=True))
+
+    class IsMember(BasePermissionComponent):
+        needs = ("memberships",)
+
+        def has_permission(self, permission, request, view):
+            return True
+
+        def has_object_permission(self, permission, request, view, obj):
+            return obj.group in get_dependency(request, "memberships")
+
+        def get_object_permission_q(self, permission, request, view):
+            return Q(group__in=get_dependency(request, "memberships"))
+
+    class IsNotLocked(BasePermissionComponent):
+        # Only checked in python, object by object
+        def has_permission(self, permission, request, view):
+            return True
+
+        def has_object_permission(self, permission, request, view, obj):
+            return obj.pk % 10 != 0
+
+    def member_key(permission, request, view, obj=None):
+        if obj is None or request.user.is_anonymous:
+            return None
+        return "{0}:{1}".format(request.user.pk, obj.pk)
+
+    def object_set(member):
+        return (IsNotLocked() &
+                ((AllowOnlySafeHttpMethod() & ObjectAttrEqualToObjectAttr("obj.public", "True")) |
+                 (AllowOnlyAuthenticated() &
+                  (ObjectAttrEqualToObjectAttr("request.user.pk", "obj.owner") | member))))
+
+    global_set = lambda: AllowOnlySafeHttpMethod() | AllowOnlyAuthenticated()
+
+    class PlainPermission(BaseComposedPermission):
+        dependency_providers = {"memberships": load_memberships}
+        global_permission_set = lambda self: global_set()
+        object_permission_set = lambda self: object_set(IsMember())
+
+    compiled_global_set = ByMethod.compile(global_set())
+    compiled_object_set = ByMethod.compile(object_set(IsMember()))
+
+    class CompiledPermission(PlainPermission):
+        global_permission_set = lambda self: compiled_global_set
+        object_permission_set = lambda self: compiled_object_set
+
+    class ProfiledPermission(ProfiledPermissionMixin, PlainPermission):
+        profiler = SamplingProfiler(sample_rate=0.1)
+
+    class CachedPermission(PlainPermission):
+        object_permission_set = lambda self: object_set(Cached(IsMember, member_key, timeout=60,
+                                                               key_prefix="member"))
+
+    class BudgetPermission(QueryBudgetMixin, PlainPermission):
+        query_budget = 1
+
+    return {
+        "plain": PlainPermission,
+        "compiled": CompiledPermission,
+        "profiled": ProfiledPermission,
+        "cached": CachedPermission,
+        "budget": BudgetPermission,
+    }
+
+
+def build_views(permission_class):
+    from rest_framework import generics
+    from rest_framework.pagination import PageNumberPagination
+    from rest_framework.response import Response
+
+    from restfw_composed_permissions.filters import ComposedPermissionFilterBackend
+
+    Item, _ = get_models()
+
+    class Pagination(PageNumberPagination):
+        page_size = 20
+
+    class ItemViewMixin(object):
+        queryset = Item.objects.order_by("pk")
+        permission_classes = (permission_class,)
+        filter_backends = (ComposedPermissionFilterBackend,)
+
+    class ItemList(ItemViewMixin, generics.GenericAPIView):
+        pagination_class = Pagination
+
+        def get(self, request):
+            page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+            return self.get_paginated_response([item.pk for item in page])
+
+        def post(self, request):
+            return Response(status=201)
+
+    class ItemDetail(ItemViewMixin, generics.GenericAPIView):
+        def get(self, request, pk):
+            return Response({"pk": self.get_object().pk})
+
+        def put(self, request, pk):
+            return Response({"pk": self.get_object().pk})
+
+    return ItemList.as_view(), ItemDetail.as_view()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run(mode="plain", requests=1000, concurrency=4, items=100, users=20,
+        anonymous_ratio=0.3, unsafe_ratio=0.2, list_ratio=0.2, seed=None):
+    """
+    Fill the database with `items` items, send `requests` requests
+    with the given traffic mix from `concurrency` threads and return
+    a dict with the results.
+    """
+    from django.core.cache import cache
+    from django.db import connection
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    setup_database(items=items, users=users)
+    cache.clear()
+
+    Item, _ = get_models()
+    pks = list(Item.objects.values_list("pk", flat=True))
+
+    permission_class = build_permissions()[mode]
+    list_view, detail_view = build_views(permission_class)
+
+    factory = APIRequestFactory()
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (1 if i < requests % concurrency else 0)
+                  for i in range(concurrency)]
+
+    def make_request(rnd):
+        user = User() if rnd.random() < anonymous_ratio else User(rnd.randrange(users))
+        unsafe = rnd.random() < unsafe_ratio
+
+        if rnd.random() < list_ratio:
+            view, kwargs = list_view, {}
+            request = factory.post("/items/") if unsafe else factory.get("/items/")
+        else:
+            pk = rnd.choice(pks)
+            view, kwargs = detail_view, {"pk": pk}
+            path = "/items/{0}/".format(pk)
+            request = factory.put(path) if unsafe else factory.get(path)
+
+        force_authenticate(request, user=user)
+        return view, request, kwargs
+
+    def worker(count, worker_seed):
+        rnd = random.Random(worker_seed)
+        counter = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            counter[0] += 1
+            return execute(sql, params, many, context)
+
+        _latencies, _queries = [], []
+        try:
+            with connection.execute_wrapper(count_queries):
+                for _ in range(count):
+                    view, request, kwargs = make_request(rnd)
+                    counter[0] = 0
+
+                    start = default_timer()
+                    view(request, **kwargs).render()
+                    _latencies.append(default_timer() - start)
+                    _queries.append(counter[0])
+        except Exception as e:
+            with lock:
+                errors.append(e)
+        finally:
+            connection.close()
+
+        with lock:
+            latencies.extend(_latencies)
+            queries.extend(_queries)
+
+    seeds = random.Random(seed)
+    threads = [threading.Thread(target=worker, args=(count, seeds.random()))
+               for count in per_thread]
+
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - start
+
+    if errors:
+        raise errors[0]
+
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "queries_per_request": float(sum(queries)) / len(queries) if queries else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", action="append", choices=MODES,
+                        help="evaluation mode, can be repeated (default: all)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--anonymous-ratio", type=float, default=0.3)
+    parser.add_argument("--unsafe-ratio", type=float, default=0.2)
+    parser.add_argument("--list-ratio", type=float, default=0.2)
+    parser.add_argument("--cache-backend", choices=("locmem", "file"), default="locmem",
+                        help="django cache backend used by the cached mode")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                          "restfw_composed_permissions.tests.settings_sqlite")
+    import django
+    from django.conf import settings
+
+    # Threads need a database file for sharing the data, the
+    # test settings rely on the test runner for the database name.
+    tmpdir = tempfile.mkdtemp()
+    settings.DATABASES["default"].setdefault("NAME", os.path.join(tmpdir, "loadtest.sqlite3"))
+    settings.ALLOWED_HOSTS = ["testserver"]
+
+    if args.cache_backend == "file":
+        settings.CACHES = {"default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.path.join(tmpdir, "cache"),
+        }}
+
+    django.setup()
+
+    print("{0:<10} {1:>8} {2:>10} {3:>10} {4:>10} {5:>8}".format(
+        "mode", "requests", "req/s", "p50 ms", "p99 ms", "queries"))
+
+    try:
+        for mode in args.mode or MODES:
+            result = run(mode=mode, requests=args.requests, concurrency=args.concurrency,
+                         items=args.items, users=args.users,
+                         anonymous_ratio=args.anonymous_ratio,
+                         unsafe_ratio=args.unsafe_ratio,
+                         list_ratio=args.list_ratio, seed=args.seed)
+
+            print("{mode:<10} {requests:>8} {throughput:>10.1f} {p50:>10.3f} "
+                  "{p99:>10.3f} {queries:>8.2f}".format(
+                      mode=result["mode"], requests=result["requests"],
+                      throughput=result["throughput"], p50=result["p50"] * 1000,
+                      p99=result["p99"] * 1000, queries=result["queries_per_request"]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,42 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase, tag
+from django.db import models
+from django.test import TestCase, TransactionTestCase, tag
 from restfw_composed_permissions.base import (BaseComposedPermission,
                                               BasePermissionComponent,
                                               RestPermissionComponent,
-                                              And, Or, Not)
-
+                                              And, Or, Not,
+                                              get_dependency)
+
+from restfw_composed_permissions.budget import QueryBudgetExceeded, QueryBudgetMixin
+from restfw_composed_permissions.cache import Cached
+from restfw_composed_permissions.filters import ComposedPermissionFilterBackend
+from restfw_composed_permissions.profiling import (ProfiledPermissionMixin,
+                                                   SamplingProfiler)
 from restfw_composed_permissions.generic import components
+from restfw_composed_permissions.tests import loadtest
+
+
+class Document(models.Model):
+    id = models.AutoField(primary_key=True)
+    owner = models.IntegerField()
+    public = models.BooleanField(default=False)
+    reviewer = models.IntegerField(null=True)
+
+    @property
+    def is_public(self):
+        return self.public
+
+    class Meta:
+        app_label = "restfw_composed_permissions"
+
+
+class Comment(models.Model):
+    id = models.AutoField(primary_key=True)
+    document = models.ForeignKey(Document, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = "restfw_composed_permissions"
 
 
 def create_component(value, instance=False):
@@ -190,6 +220,712 @@ class CorePermissionFrameworkTests(TestCase):
 
         self.assertTrue(permission.has_permission(None, None))
 
+    def test_iter_permitted(self):
+        chunks = []
+
+        class EvenComponent(BasePermissionComponent):
+            def has_permission(self, permission, request, view):
+                return True
+
+            def has_object_permission(self, permission, request, view, obj):
+                return obj % 2 == 0
+
+            def prepare_object_chunk(self, permission, request, view, objs):
+                chunks.append(list(objs))
+
+        permission = create_permission(None, lambda: EvenComponent() & create_component(True)())()
+        result = permission.iter_permitted(None, None, iter(range(7)), chunk_size=3)
+
+        self.assertEqual(list(result), [0, 2, 4, 6])
+        self.assertEqual(chunks, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_iter_permitted_is_lazy(self):
+        chunks = []
+
+        class RestComponent(RestPermissionComponent):
+            def has_permission(self, request, view):
+                return True
+
+            def prepare_object_chunk(self, request, view, objs):
+                chunks.append(list(objs))
+
+        permission = create_permission(None, lambda: RestComponent)()
+        result = permission.iter_permitted(None, None, range(10), chunk_size=4)
+
+        self.assertEqual(next(result), 0)
+        self.assertEqual(chunks, [[0, 1, 2, 3]])
+
+    def test_filter_permitted_objects(self):
+        calls = []
+
+        class MultipleComponent(RestPermissionComponent):
+            def __init__(self, number):
+                self.number = number
+
+            def has_permission(self, request, view):
+                return True
+
+            def has_object_permission(self, request, view, obj):
+                raise AssertionError("objects are checked in bulk")
+
+            def filter_permitted_objects(self, request, view, objs):
+                calls.append((self.number, list(objs)))
+                return [obj for obj in objs if obj % self.number == 0]
+
+        permission_set = lambda: ((MultipleComponent(2) & ~MultipleComponent(3)) |
+                                  MultipleComponent(5))
+        permission = create_permission(None, permission_set)()
+        result = permission.iter_permitted(None, None, range(11), chunk_size=20)
+
+        self.assertEqual(list(result), [0, 2, 4, 5, 8, 10])
+        self.assertEqual(calls, [(2, list(range(11))),
+                                 (3, [0, 2, 4, 6, 8, 10]),
+                                 (5, [0, 1, 3, 5, 6, 7, 9])])
+
+
+class CachedPermissionSetTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def make_counting_component(self, value):
+        calls = []
+
+        class CountingComponent(BasePermissionComponent):
+            def has_permission(self, permission, request, view):
+                calls.append(None)
+                return value
+
+        return CountingComponent, calls
+
+    def test_decision_is_cached(self):
+        Component, calls = self.make_counting_component(False)
+        permission = create_permission(lambda: Cached(Component, lambda *args: "key",
+                                                      key_prefix="counting"))
+
+        self.assertFalse(permission().has_permission(None, None))
+        self.assertFalse(permission().has_permission(None, None))
+        self.assertEqual(len(calls), 1)
+
+    def test_none_key_is_not_cached(self):
+        Component, calls = self.make_counting_component(True)
+        permission = create_permission(lambda: Cached(Component, lambda *args: None,
+                                                      key_prefix="counting"))
+
+        self.assertTrue(permission().has_permission(None, None))
+        self.assertTrue(permission().has_permission(None, None))
+        self.assertEqual(len(calls), 2)
+
+    def test_object_decisions_use_obj_key(self):
+        calls = []
+
+        class CountingComponent(BasePermissionComponent):
+            def has_permission(self, permission, request, view):
+                calls.append("global")
+                return True
+
+            def has_object_permission(self, permission, request, view, obj):
+                calls.append(obj)
+                return obj == 1
+
+        key_func = lambda permission, request, view, obj=0: obj
+        Permission = create_permission(lambda: Cached(CountingComponent, key_func, key_prefix="c"),
+                                       lambda: Cached(CountingComponent, key_func, key_prefix="c"))
+
+        for _ in range(2):
+            self.assertTrue(Permission().has_permission(None, None))
+            self.assertTrue(Permission().has_object_permission(None, None, 1))
+            self.assertFalse(Permission().has_object_permission(None, None, 2))
+
+        self.assertEqual(calls, ["global", 1, 2])
+
+    def test_components_sharing_key_func(self):
+        key_func = lambda *args: "user:1"
+        both = create_permission(lambda: Cached(components.AllowAll, key_func) &
+                                         Cached(components.DenyAll, key_func))
+        deny = create_permission(lambda: Cached(components.DenyAll, key_func))
+        allow = create_permission(lambda: Cached(components.AllowAll, key_func))
+
+        self.assertFalse(both().has_permission(None, None))
+        self.assertFalse(deny().has_permission(None, None))
+        self.assertTrue(allow().has_permission(None, None))
+
+    def test_component_attributes_in_key(self):
+        key_func = lambda *args: "user:1"
+        permission_set = lambda value: Cached(
+            components.ObjectAttrEqualToObjectAttr("obj.x", value), key_func)
+
+        obj = type("Obj", (object,), {"x": 1})()
+        first = create_permission(None, lambda: permission_set("1"))()
+        second = create_permission(None, lambda: permission_set("2"))()
+
+        self.assertTrue(first.has_object_permission(None, None, obj))
+        self.assertFalse(second.has_object_permission(None, None, obj))
+
+    def test_key_prefix(self):
+        Component, calls = self.make_counting_component(True)
+        key_func = lambda *args: "key"
+        first = create_permission(lambda: Cached(Component, key_func, key_prefix="a"))
+        second = create_permission(lambda: Cached(Component, key_func, key_prefix="b"))
+
+        self.assertTrue(first().has_permission(None, None))
+        self.assertTrue(second().has_permission(None, None))
+        self.assertEqual(len(calls), 2)
+
+    def test_decisions_shared_through_file_cache(self):
+        import shutil
+        import tempfile
+        from django.core.cache.backends.filebased import FileBasedCache
+        from django.test import override_settings
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                       "LOCATION": location},
+        }
+
+        Component, calls = self.make_counting_component(False)
+
+        def create(user):
+            return create_permission(lambda: Cached(Component, lambda *args: user,
+                                                    cache_alias="shared",
+                                                    key_prefix="counting"))
+
+        with override_settings(CACHES=caches):
+            self.assertFalse(create("user:1")().has_permission(None, None))
+
+            # Other handle on the same location, like the one of other process
+            other = FileBasedCache(location, {})
+            cached = create("user:1")().global_permission_set()
+            self.assertIs(other.get(cached.make_key("has_permission", "user:1")), False)
+
+            other.set(cached.make_key("has_permission", "user:2"), True)
+            self.assertTrue(create("user:2")().has_permission(None, None))
+
+        self.assertEqual(len(calls), 1)
+
+    def test_identity_requires_simple_values(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        key_func = lambda *args: "key"
+        component = components.ObjectAttrEqualToObjectAttr("obj.owner", "request.user.pk")
+        component.documents = Document.objects.all()
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(ImproperlyConfigured):
+                Cached(component, key_func)
+            Cached(component, key_func, key_prefix="documents")
+
+        # Classes defined inside functions
+        with self.assertRaises(ImproperlyConfigured):
+            Cached(create_component(True), key_func)
+
+        identity = Cached(components.ByMethod({"GET": components.AllowAll}) &
+                          ~components.AllowOnlyAuthenticated(), key_func).component_identity
+        self.assertNotIn("0x", identity)
+        self.assertIn("'GET':0", identity)
+
+
+class FilterBackendTests(TestCase):
+    def setUp(self):
+        Document.objects.create(owner=1, public=True)
+        Document.objects.create(owner=1, public=False)
+        Document.objects.create(owner=2, public=True)
+        Document.objects.create(owner=2, public=False, reviewer=1)
+
+        self.request = self.make_mock()
+        self.request.user = self.make_mock()
+        self.request.user.pk = 1
+        self.request.user.is_anonymous = False
+        self.request.method = "GET"
+
+    def make_mock(self):
+        class Mock(object):
+            pass
+
+        return Mock()
+
+    def make_view(self, permission_set, permission=None):
+        if permission is None:
+            permission = create_permission(None, permission_set)
+
+        class View(object):
+            def get_permissions(self):
+                return [permission()]
+
+            def get_queryset(self):
+                return Document.objects.all()
+
+        return View()
+
+    def filter_queryset(self, permission_set, permission=None):
+        backend = ComposedPermissionFilterBackend()
+        return backend.filter_queryset(self.request, Document.objects.order_by("pk"),
+                                       self.make_view(permission_set, permission))
+
+    def filter(self, permission_set, permission=None):
+        return [(d.owner, d.public) for d in self.filter_queryset(permission_set, permission)]
+
+    def python_filter(self, permission_set):
+        permission = create_permission(None, permission_set)()
+        return [(d.owner, d.public) for d in Document.objects.order_by("pk")
+                if permission.has_object_permission(self.request, None, d)]
+
+    def test_database_filter(self):
+        permission_set = lambda: (components.ObjectAttrEqualToObjectAttr("request.user.pk", "obj.owner") |
+                                  ~components.AllowOnlySafeHttpMethod())
+
+        with self.assertNumQueries(1):
+            result = self.filter(permission_set)
+
+        self.assertEqual(result, [(1, True), (1, False)])
+
+    def test_python_fallback(self):
+        class PublicComponent(BasePermissionComponent):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.public
+
+        permission_set = lambda: (components.AllowOnlyAuthenticated() &
+                                  PublicComponent() &
+                                  components.ObjectAttrEqualToObjectAttr("obj.owner", "request.user.pk"))
+
+        self.assertEqual(self.filter(permission_set), [(1, True)])
+
+    def test_python_fallback_in_or(self):
+        class PublicComponent(BasePermissionComponent):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.public
+
+        permission_set = lambda: (PublicComponent() |
+                                  components.ObjectAttrEqualToObjectAttr("obj.owner", "request.user.pk"))
+
+        self.assertEqual(self.filter(permission_set), [(1, True), (1, False), (2, True)])
+
+    def test_constant_filters(self):
+        self.assertEqual(len(self.filter(lambda: components.AllowAll)), 4)
+        self.assertEqual(len(self.filter(lambda: ~components.AllowAll())), 0)
+
+    def test_overridden_object_permission_is_not_constant(self):
+        class Owner(components.AllowOnlyAuthenticated):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.owner == request.user.pk
+
+        self.assertEqual(self.filter(lambda: Owner), [(1, True), (1, False)])
+
+    def test_invalid_lookups_are_checked_in_python(self):
+        # Property instead of field
+        permission_set = lambda: components.ObjectAttrEqualToObjectAttr("obj.is_public", "True")
+        self.assertEqual(self.filter(permission_set), [(1, True), (2, True)])
+
+        # Value of other type than the field
+        permission_set = lambda: components.ObjectAttrEqualToObjectAttr("request.user", "obj.owner")
+        self.assertEqual(self.filter(permission_set), [])
+
+    def test_values_of_other_type_are_checked_in_python(self):
+        # The database would convert the string to the integer of the field
+        permission_set = lambda: components.ObjectAttrEqualToObjectAttr("obj.owner", "'1'")
+        queryset = self.filter_queryset(permission_set)
+        self.assertNotIn("WHERE", str(queryset.query))
+        self.assertEqual(list(queryset), [])
+
+        permission_set = lambda: components.ObjectAttrEqualToObjectAttr("obj.public", "1")
+        self.assertNotIn("WHERE", str(self.filter_queryset(permission_set).query))
+        self.assertEqual(self.filter(permission_set), self.python_filter(permission_set))
+
+        permission_set = lambda: components.ObjectAttrEqualToObjectAttr("obj.pk", "request.user.pk")
+        self.assertIn("WHERE", str(self.filter_queryset(permission_set).query))
+        self.assertEqual(self.filter(permission_set), [(1, True)])
+
+    def test_relations_are_compared_like_python(self):
+        documents = list(Document.objects.order_by("pk"))
+        Comment.objects.create(document=documents[0])
+        Comment.objects.create(document=documents[2])
+        Comment.objects.create(document=None)
+
+        def filter_comments(obj_attr, value_attr):
+            permission = create_permission(None, lambda: components.ObjectAttrEqualToObjectAttr(
+                obj_attr, value_attr))
+
+            class View(object):
+                def get_permissions(self):
+                    return [permission()]
+
+                def get_queryset(self):
+                    return Comment.objects.all()
+
+            queryset = ComposedPermissionFilterBackend().filter_queryset(
+                self.request, Comment.objects.order_by("pk"), View())
+            return "WHERE" in str(queryset.query), [c.document_id for c in queryset]
+
+        pk = documents[0].pk
+
+        # Related instance compared with a primary key in python
+        self.assertEqual(filter_comments("obj.document", "request.user.pk"), (False, []))
+        self.assertEqual(filter_comments("obj.document_id", str(pk)), (True, [pk]))
+        self.assertEqual(filter_comments("obj.document.owner", "request.user.pk"), (True, [pk]))
+
+        # The database matches a missing document as NULL
+        self.assertEqual(filter_comments("obj.document.reviewer", "None"),
+                         (False, [pk, documents[2].pk]))
+        self.assertEqual(filter_comments("obj.document_id", "None"), (True, [None]))
+
+    def test_not_matches_null_values(self):
+        permission_set = lambda: ~components.ObjectAttrEqualToObjectAttr("obj.reviewer",
+                                                                          "request.user.pk")
+        self.assertEqual(self.filter(permission_set), self.python_filter(permission_set))
+        self.assertEqual(len(self.filter(permission_set)), 3)
+
+    def test_instrumented_permission_set_is_split(self):
+        class PublicComponent(BasePermissionComponent):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.public
+
+        class Permission(QueryBudgetMixin, BaseComposedPermission):
+            object_permission_set = lambda self: (
+                PublicComponent() &
+                components.ObjectAttrEqualToObjectAttr("obj.owner", "request.user.pk"))
+
+        queryset = self.filter_queryset(None, Permission)
+        self.assertIn("WHERE", str(queryset.query))
+        self.assertEqual([(d.owner, d.public) for d in queryset], [(1, True)])
+
+    def test_instrumented_leaves(self):
+        from django.db.models import Q
+
+        class PublicComponent(RestPermissionComponent):
+            def has_object_permission(self, request, view, obj):
+                return obj.public
+
+        class OwnerComponent(RestPermissionComponent):
+            needs = ("owners",)
+
+            def has_object_permission(self, request, view, obj):
+                return obj.owner in get_dependency(request, "owners")
+
+            def get_object_permission_q(self, request, view):
+                return Q(owner__in=get_dependency(request, "owners"))
+
+        class BasePermission(BaseComposedPermission):
+            dependency_providers = {"owners": lambda permission, request, view: [1]}
+            object_permission_set = lambda self: PublicComponent() & OwnerComponent()
+
+        class BudgetPermission(QueryBudgetMixin, BasePermission):
+            pass
+
+        class ProfiledPermission(ProfiledPermissionMixin, BasePermission):
+            profiler = SamplingProfiler(sample_rate=1)
+
+        for Permission in (BudgetPermission, ProfiledPermission):
+            self.request = self.make_mock()
+            queryset = self.filter_queryset(None, Permission)
+            self.assertIn("WHERE", str(queryset.query))
+            self.assertEqual([(d.owner, d.public) for d in queryset], [(1, True)])
+
+    def test_python_checks_are_streamed(self):
+        class PublicComponent(BasePermissionComponent):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.public
+
+        # More objects than the query parameters supported by sqlite
+        Document.objects.bulk_create([Document(owner=1, public=i % 2 == 0)
+                                      for i in range(1200)])
+
+        queryset = self.filter_queryset(lambda: PublicComponent)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(queryset)), 602)
+
+        # Slices are taken from the permitted objects
+        self.assertEqual([d.public for d in queryset.all()[10:20]], [True] * 10)
+
+    def test_python_checked_queryset(self):
+        from django.core.paginator import Paginator
+        from django.db import NotSupportedError
+
+        class PublicComponent(BasePermissionComponent):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj.public
+
+        queryset = self.filter_queryset(lambda: PublicComponent)
+        self.assertEqual(queryset.count(), 2)
+        self.assertTrue(queryset.exists())
+        self.assertFalse(queryset.filter(public=False).exists())
+        self.assertEqual(queryset[1].owner, 2)
+
+        page = Paginator(queryset, 1).page(2)
+        self.assertEqual([(d.owner, d.public) for d in page], [(2, True)])
+        self.assertFalse(page.has_next())
+
+        with self.assertRaises(NotSupportedError):
+            queryset.values_list("pk", flat=True)
+        with self.assertRaises(NotSupportedError):
+            queryset.aggregate(models.Count("pk"))
+
+
+class SamplingProfilerTests(TestCase):
+    def create_permission(self, profiler, callback):
+        class Permission(ProfiledPermissionMixin, BaseComposedPermission):
+            global_permission_set = lambda self: callback()
+
+        Permission.profiler = profiler
+        return Permission
+
+    def test_report(self):
+        profiler = SamplingProfiler(sample_rate=1)
+        Permission = self.create_permission(profiler, lambda: (create_component(True)() |
+                                                              create_component(False)()))
+
+        self.assertTrue(Permission().has_permission(None, None))
+        self.assertTrue(Permission().has_permission(None, None))
+
+        report = dict((";".join(e["path"]), e) for e in profiler.report())
+        self.assertEqual(sorted(report), ["Or", "Or;Or", "Or;Or;SimpleComponent"])
+        self.assertEqual(report["Or;Or"]["calls"], 2)
+        self.assertEqual(report["Or;Or"]["short_circuit_rate"], 1.0)
+        self.assertEqual(report["Or"]["short_circuit_rate"], 0.0)
+
+        self.assertEqual(len(profiler.to_collapsed().splitlines()), 3)
+        self.assertIn('"calls": 2', profiler.to_json())
+
+    def test_sampled_per_request(self):
+        import random
+
+        class Request(object):
+            method = "GET"
+
+        profiler = SamplingProfiler(sample_rate=0.5)
+        Permission = self.create_permission(profiler, lambda: create_component(True))
+        Permission.object_permission_set = lambda self: create_component(True)
+
+        state = random.getstate()
+        self.addCleanup(random.setstate, state)
+        random.seed(0)
+
+        sampled = []
+        for _ in range(20):
+            request = Request()
+            profiler.reset()
+            for _ in range(5):
+                Permission().has_permission(request, None)
+                Permission().has_object_permission(request, None, None)
+            calls = sum(e["calls"] for e in profiler.report() if len(e["path"]) == 1)
+            self.assertIn(calls, (0, 10))
+            sampled.append(calls == 10)
+
+        self.assertIn(True, sampled)
+        self.assertIn(False, sampled)
+
+    def test_single_child_sets_do_not_short_circuit(self):
+        class Request(object):
+            method = "GET"
+
+        profiler = SamplingProfiler(sample_rate=1)
+        Permission = self.create_permission(profiler, lambda: components.ByMethod({
+            "GET": components.AllowAll,
+            "POST": components.DenyAll,
+        }))
+
+        self.assertTrue(Permission().has_permission(Request(), None))
+
+        report = dict((";".join(e["path"]), e) for e in profiler.report())
+        self.assertEqual(report["Or;ByMethod"]["short_circuit_rate"], 0.0)
+
+    def test_not_sampled(self):
+        profiler = SamplingProfiler(sample_rate=0)
+        Permission = self.create_permission(profiler, lambda: create_component(True))
+
+        self.assertTrue(Permission().has_permission(None, None))
+        self.assertEqual(profiler.report(), [])
+
+
+class DependenciesTests(TestCase):
+    def make_request(self):
+        class Request(object):
+            pass
+
+        return Request()
+
+    def create_permission(self, calls, callback):
+        def load_memberships(permission, request, view):
+            calls.append("memberships")
+            return [1, 2]
+
+        class Permission(BaseComposedPermission):
+            dependency_providers = {"memberships": load_memberships}
+            global_permission_set = lambda self: callback()
+            object_permission_set = lambda self: callback()
+
+        return Permission
+
+    def create_member_component(self):
+        class MemberComponent(RestPermissionComponent):
+            needs = ("memberships",)
+
+            def has_permission(self, request, view):
+                return 1 in get_dependency(request, "memberships")
+
+        return MemberComponent
+
+    def test_dependency_is_shared(self):
+        calls = []
+        Member = self.create_member_component()
+        Permission = self.create_permission(calls, lambda: Member() & Member())
+
+        request = self.make_request()
+        self.assertTrue(Permission().has_permission(request, None))
+        self.assertTrue(Permission().has_object_permission(request, None, None))
+        self.assertEqual(calls, ["memberships"])
+
+    def test_dependency_is_lazy(self):
+        calls = []
+        Member = self.create_member_component()
+        Permission = self.create_permission(calls, lambda: create_component(True)() | Member())
+
+        self.assertTrue(Permission().has_permission(self.make_request(), None))
+        self.assertEqual(list(Permission().iter_permitted(self.make_request(), None, [1])), [1])
+        self.assertEqual(calls, [])
+
+    def test_dependency_in_database_filter(self):
+        from django.db.models import Q
+
+        calls = []
+
+        class OwnerComponent(RestPermissionComponent):
+            needs = ("memberships",)
+
+            def has_permission(self, request, view):
+                return True
+
+            def get_object_permission_q(self, request, view):
+                return Q(owner__in=get_dependency(request, "memberships"))
+
+        Document.objects.create(owner=1)
+        Document.objects.create(owner=3)
+
+        Permission = self.create_permission(calls, lambda: OwnerComponent)
+
+        class View(object):
+            def get_permissions(self):
+                return [Permission()]
+
+        queryset = ComposedPermissionFilterBackend().filter_queryset(
+            self.make_request(), Document.objects.all(), View())
+        self.assertEqual([d.owner for d in queryset], [1])
+        self.assertEqual(calls, ["memberships"])
+
+    def test_missing_provider(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        class Component(create_component(True)):
+            needs = ("unknown",)
+
+        Permission = self.create_permission([], lambda: Component)
+        with self.assertRaises(ImproperlyConfigured):
+            Permission().has_permission(self.make_request(), None)
+
+    def test_conflicting_providers(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        Member = self.create_member_component()
+        First = self.create_permission([], lambda: Member)
+        Second = self.create_permission([], lambda: Member)
+
+        request = self.make_request()
+        self.assertTrue(First().has_permission(request, None))
+        self.assertTrue(First().has_permission(request, None))
+        with self.assertRaises(ImproperlyConfigured):
+            Second().has_permission(request, None)
+
+        # Other requests are not affected
+        self.assertTrue(Second().has_permission(self.make_request(), None))
+
+    def test_dependency_without_request(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        Permission = self.create_permission([], self.create_member_component())
+        with self.assertRaises(ImproperlyConfigured):
+            Permission().has_permission(None, None)
+
+
+class QueryBudgetTests(TestCase):
+    def create_query_component(self, queries, budget=None):
+        class QueryComponent(BasePermissionComponent):
+            query_budget = budget
+
+            def has_permission(self, permission, request, view):
+                for _ in range(queries):
+                    list(Document.objects.all())
+                return True
+
+        return QueryComponent
+
+    def create_permission(self, callback, budget=None, action="log", profiler=None):
+        class Permission(QueryBudgetMixin, ProfiledPermissionMixin, BaseComposedPermission):
+            query_budget = budget
+            query_budget_action = action
+            global_permission_set = lambda self: callback()
+
+        Permission.profiler = profiler
+        return Permission
+
+    def test_query_counts(self):
+        profiler = SamplingProfiler(sample_rate=1)
+        Component = self.create_query_component(2)
+        permission = self.create_permission(lambda: Component() & Component(),
+                                            profiler=profiler)()
+
+        self.assertTrue(permission.has_permission(None, None))
+        self.assertEqual(permission.query_counts[("Or",)], 4)
+        self.assertEqual(permission.query_counts[("Or", "And", "QueryComponent")], 4)
+
+        report = dict((";".join(e["path"]), e) for e in profiler.report())
+        self.assertEqual(report["Or"]["queries"], 4)
+        self.assertEqual(report["Or"]["self_queries"], 0)
+        self.assertEqual(report["Or;And;QueryComponent"]["queries"], 4)
+
+    def test_component_budget(self):
+        Component = self.create_query_component(2, budget=1)
+        permission = self.create_permission(lambda: Component, action="raise")()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            permission.has_permission(None, None)
+
+    def test_tree_budget(self):
+        Component = self.create_query_component(1, budget=1)
+        permission = self.create_permission(lambda: Component() & Component(), budget=1)()
+
+        with self.assertLogs("restfw_composed_permissions", "WARNING"):
+            self.assertTrue(permission.has_permission(None, None))
+
+    def test_dependency_queries(self):
+        def load_documents(permission, request, view):
+            return list(Document.objects.all()) + list(Document.objects.all())
+
+        class Component(self.create_query_component(0, budget=0)):
+            needs = ("documents",)
+
+        class Permission(self.create_permission(lambda: Component() & Component(),
+                                                budget=2, action="raise")):
+            dependency_providers = {"documents": load_documents}
+
+        class Request(object):
+            pass
+
+        permission = Permission()
+        self.assertTrue(permission.has_permission(Request(), None))
+        self.assertEqual(permission.query_counts[("Or",)], 2)
+        self.assertEqual(permission.query_counts[("Or", "And", "dependency:documents")], 2)
+        self.assertEqual(permission.query_counts[("Or", "And", "Component")], 0)
+
+        profiler = SamplingProfiler(sample_rate=1)
+        Permission.profiler = profiler
+        self.assertTrue(Permission().has_permission(Request(), None))
+
+        report = dict((";".join(e["path"]), e) for e in profiler.report())
+        self.assertEqual(report["Or;And;dependency:documents"]["queries"], 2)
+        self.assertEqual(report["Or;And"]["self_queries"], 0)
+
 
 class GenericComponentsTests(TestCase):
     def make_mock(self):
@@ -236,3 +972,78 @@ class GenericComponentsTests(TestCase):
 
         instance = components.ObjectAttrEqualToObjectAttr("obj.x", "obj.y")
         self.assertTrue(instance.has_object_permission(None, None, None, obj))
+
+
+class ByMethodTests(TestCase):
+    def make_request(self, method):
+        class Request(object):
+            pass
+
+        request = Request()
+        request.method = method
+        return request
+
+    def test_by_method(self):
+        permission_set = components.ByMethod({"GET": components.AllowAll,
+                                              "POST": create_component(False)})
+        permission = create_permission(lambda: permission_set)()
+
+        self.assertTrue(permission.has_permission(self.make_request("GET"), None))
+        self.assertFalse(permission.has_permission(self.make_request("POST"), None))
+        self.assertFalse(permission.has_permission(self.make_request("PUT"), None))
+
+    def test_specialize_for_method(self):
+        Component = create_component(True)
+        permission_set = (components.AllowOnlySafeHttpMethod() |
+                          (Component() & ~components.AllowOnlySafeHttpMethod()))
+
+        get_set = components.specialize_for_method(permission_set, "GET")
+        post_set = components.specialize_for_method(permission_set, "post")
+
+        self.assertIsInstance(get_set, components.AllowAll)
+        self.assertIsInstance(post_set, Component)
+
+    def test_overridden_components_are_not_folded(self):
+        class SafeOwner(components.AllowOnlySafeHttpMethod):
+            def has_object_permission(self, permission, request, view, obj):
+                return obj == "owner"
+
+        class Staff(components.AllowAll):
+            def has_permission(self, permission, request, view):
+                return False
+
+        class SafeMethod(components.AllowOnlySafeHttpMethod):
+            def get_method_result(self, method):
+                return method == "GET"
+
+        permission_set = SafeOwner() | Staff()
+        specialized = components.specialize_for_method(permission_set, "GET")
+
+        self.assertIs(type(specialized), Or)
+        self.assertEqual([type(c) for c in specialized.components], [SafeOwner, Staff])
+        self.assertIsInstance(components.specialize_for_method(SafeMethod(), "HEAD"),
+                              components.DenyAll)
+
+        permission = create_permission(None, lambda: components.ByMethod.compile(permission_set))()
+        self.assertFalse(permission.has_object_permission(self.make_request("GET"), None, "other"))
+        self.assertTrue(permission.has_object_permission(self.make_request("GET"), None, "owner"))
+
+    def test_compile(self):
+        permission_set = components.ByMethod.compile(components.AllowOnlySafeHttpMethod() &
+                                                     create_component(True)())
+        permission = create_permission(lambda: permission_set)()
+
+        self.assertIsInstance(permission_set.get_method_component("DELETE"), components.DenyAll)
+        self.assertTrue(permission.has_permission(self.make_request("GET"), None))
+        self.assertFalse(permission.has_permission(self.make_request("DELETE"), None))
+        self.assertFalse(permission.has_permission(self.make_request("TRACE"), None))
+        self.assertIsInstance(permission_set.get_method_component("TRACE"), And)
+
+
+class LoadTestHarnessTests(TransactionTestCase):
+    def test_run(self):
+        for mode in loadtest.MODES:
+            result = loadtest.run(mode=mode, requests=50, concurrency=2, seed=1)
+            self.assertEqual(result["requests"], 50)
+            self.assertTrue(result["p99"] >= result["p50"])
+            self.assertTrue(result["queries_per_request"] > 0)